@@ -1,12 +1,23 @@
-import json
-import threading
+import signal
+import sys
 
 from dotenv import load_dotenv
 
 from example.services.rabbit import rabbit
+from w_pika import json_body_parser, json_msg_parser
 
 load_dotenv()
 
+
+def shutdown(signum, frame):
+    # Finish and ack the messages being processed before exiting
+    rabbit.stop()
+    sys.exit(0)
+
+
 if __name__ == '__main__':
-    rabbit.init_app(queue_prefix="example", body_parser=json.loads, msg_parser=json.dumps)
-    threading.Event().wait()
+    rabbit.init_app(queue_prefix="example", body_parser=json_body_parser, msg_parser=json_msg_parser)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.pause()
@@ -14,8 +14,10 @@ setup(
     keywords=["pika", "rabbitmq"],
     install_requires=[
         "pika>=1.3.2",
-        "retry>=0.9.2",
     ],
+    extras_require={
+        "orjson": ["orjson>=3.0"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
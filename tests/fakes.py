@@ -0,0 +1,93 @@
+from concurrent.futures import Future
+
+from pika.exceptions import ChannelClosedByClient
+
+
+class FakeIOLoop:
+    """Runs callbacks right away, timers only when `fire` is called"""
+
+    def __init__(self):
+        self.timers = []
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def call_later(self, delay, callback):
+        timer = (delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        self.timers.remove(timer)
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for _, callback in timers:
+            callback()
+
+
+class FakeChannel:
+    """Records every call, asynchronous ones complete right away"""
+
+    def __init__(self):
+        self.is_open = True
+        self.calls = []
+        self.close_callbacks = []
+        self.on_message = None
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def close(self, reason=ChannelClosedByClient(200, "Normal shutdown")):
+        self.is_open = False
+        for callback in self.close_callbacks:
+            callback(self, reason)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.calls.append(("basic_consume", queue))
+        self.on_message = on_message_callback
+        return f"ctag-{queue}"
+
+    def __getattr__(self, name):
+        def call(*args, callback=None, **kwargs):
+            self.calls.append((name, args, kwargs))
+            if callback is not None:
+                callback(None)
+
+        return call
+
+    def named(self, name):
+        return [call for call in self.calls if call[0] == name]
+
+
+class FakeConnection:
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self.is_open = True
+        self.is_closed = False
+        self.channels = []
+
+    def close(self):
+        self.is_open, self.is_closed = False, True
+
+    def channel(self, on_open_callback):
+        channel = FakeChannel()
+        channel.connection = self
+        self.channels.append(channel)
+        on_open_callback(channel)
+
+
+class FakePublisher:
+    """Confirms are resolved by the test"""
+
+    def __init__(self):
+        self.published = []
+        self.is_closed = True
+
+    def publish(self, exchange, routing_key, body, properties):
+        future = Future()
+        self.published.append((exchange, routing_key, body, properties, future))
+        return future
+
+    def close(self):
+        pass
@@ -0,0 +1,50 @@
+from w_pika.AckBatcher import AckBatcher
+
+from tests.fakes import FakeChannel, FakeIOLoop
+
+
+def make_batcher(batch_size=3):
+    channel, ioloop = FakeChannel(), FakeIOLoop()
+    return AckBatcher(channel, ioloop, batch_size, 0.1), channel, ioloop
+
+
+def test_acks_a_full_batch_at_once():
+    batcher, channel, ioloop = make_batcher()
+    for tag in (1, 2, 3):
+        batcher.add(tag)
+
+    assert channel.named("basic_ack") == [("basic_ack", (3,), {"multiple": True})]
+    assert ioloop.timers == []
+
+
+def test_acks_a_partial_batch_on_timeout():
+    batcher, channel, ioloop = make_batcher()
+    batcher.add(1)
+    assert channel.named("basic_ack") == []
+
+    ioloop.fire()
+    assert channel.named("basic_ack") == [("basic_ack", (1,), {"multiple": True})]
+
+
+def test_flush_without_pending_tags_or_open_channel_sends_nothing():
+    batcher, channel, _ = make_batcher()
+    batcher.flush()
+
+    batcher.add(1)
+    channel.is_open = False
+    batcher.flush()
+    assert channel.named("basic_ack") == []
+
+
+def test_hold_defers_acks_until_released():
+    batcher, channel, ioloop = make_batcher()
+    batcher.hold()
+    for tag in (2, 3, 4):
+        batcher.add(tag)
+    ioloop.fire()
+    assert channel.named("basic_ack") == []
+
+    # The held message is added after later ones
+    batcher.add(1)
+    batcher.release()
+    assert channel.named("basic_ack") == [("basic_ack", (4,), {"multiple": True})]
@@ -0,0 +1,55 @@
+import itertools
+
+import pytest
+
+from w_pika.RabbitConsumerMiddleware import (
+    RabbitConsumerMessage,
+    RabbitConsumerMiddlewareError,
+    call_middlewares,
+)
+
+
+def make_message():
+    return RabbitConsumerMessage("key", b"body", "body", None, None)
+
+
+def recorder(calls, name):
+    def middleware(message, call_next):
+        calls.append(name)
+        call_next(message)
+
+    return middleware
+
+
+def test_calls_middlewares_in_order():
+    calls = []
+    call_middlewares(make_message(), (recorder(calls, "a"), recorder(calls, "b")))
+    assert calls == ["a", "b"]
+
+
+def test_accepts_iterators():
+    calls = []
+    middlewares = itertools.chain([recorder(calls, "a")], iter([recorder(calls, "b")]))
+    call_middlewares(make_message(), middlewares)
+    assert calls == ["a", "b"]
+
+
+def test_stops_when_call_next_is_not_called():
+    calls = []
+    call_middlewares(make_message(), [lambda message, call_next: None, recorder(calls, "b")])
+    assert calls == []
+
+
+def test_raises_when_call_next_is_called_twice():
+    def twice(message, call_next):
+        call_next(message)
+        call_next(message)
+
+    with pytest.raises(RabbitConsumerMiddlewareError):
+        call_middlewares(make_message(), [twice, lambda message, call_next: call_next(message)])
+
+
+def test_message_has_no_dict_and_str_lists_its_fields():
+    message = make_message()
+    assert not hasattr(message, "__dict__")
+    assert "'routing_key': 'key'" in str(message)
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+from pika import spec
+from pika.exceptions import AMQPConnectionError, AMQPError
+
+from w_pika.RabbitPublisher import RabbitPublisher
+
+from tests.fakes import FakeChannel, FakeIOLoop
+
+
+def make_ready_publisher():
+    publisher = RabbitPublisher(None, FakeIOLoop(), lambda channel, on_ready: on_ready())
+    publisher._connection = SimpleNamespace(is_closed=False)
+    channel = FakeChannel()
+    publisher._on_ready(channel)
+    return publisher, channel
+
+
+def confirm(method):
+    return SimpleNamespace(method=method)
+
+
+def test_queues_messages_until_the_channel_is_ready():
+    publisher = RabbitPublisher(None, FakeIOLoop(), lambda channel, on_ready: on_ready())
+    publisher._connection = SimpleNamespace(is_closed=False)
+    future = publisher.publish("ex", "key", b"1", None)
+
+    channel = FakeChannel()
+    publisher._on_ready(channel)
+    assert channel.named("basic_publish") == [("basic_publish", ("ex", "key", b"1", None), {})]
+    assert not future.done()
+
+
+def test_multiple_ack_confirms_every_earlier_message():
+    publisher, _ = make_ready_publisher()
+    futures = [publisher.publish("ex", "key", b"", None) for _ in range(3)]
+
+    publisher._on_confirm(confirm(spec.Basic.Ack(delivery_tag=2, multiple=True)))
+    assert [future.done() for future in futures] == [True, True, False]
+    assert futures[0].result() is None
+
+
+def test_nack_fails_the_message():
+    publisher, _ = make_ready_publisher()
+    future = publisher.publish("ex", "key", b"", None)
+
+    publisher._on_confirm(confirm(spec.Basic.Nack(delivery_tag=1)))
+    with pytest.raises(AMQPError):
+        future.result()
+
+
+def test_fail_fails_unconfirmed_and_queued_messages():
+    publisher, _ = make_ready_publisher()
+    unconfirmed = publisher.publish("ex", "key", b"", None)
+    publisher._channel = None
+    queued = publisher.publish("ex", "key", b"", None)
+
+    publisher._fail(Exception("lost"))
+    for future in (unconfirmed, queued):
+        with pytest.raises(AMQPConnectionError):
+            future.result()
+    assert not publisher._unconfirmed and not publisher._queued
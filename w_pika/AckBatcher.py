@@ -0,0 +1,73 @@
+from typing import Any, Union
+
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.channel import Channel
+
+
+class AckBatcher:
+    """Acknowledges consumed messages in batches using `basic_ack(multiple=True)`.
+
+    Pending delivery tags are acked once `batch_size` messages have been processed or,
+    at the latest, `batch_timeout` seconds after the first pending message. Every method
+    must be called from the thread that owns the channel's connection. `scheduler` is
+    anything exposing pika's `call_later`/`remove_timeout` timer API (a
+    `BlockingConnection` or an `IOLoop`), so the flush timer also fires on that thread;
+    pika channels are not thread-safe.
+
+    `hold` keeps the batch from being acked until `release`, for a message that must not
+    be acked along with its neighbours yet, since a multiple ack also covers it."""
+
+    def __init__(
+            self,
+            channel: Union[BlockingChannel, Channel],
+            scheduler: Any,
+            batch_size: int = 50,
+            batch_timeout: float = 0.1,
+    ) -> None:
+        self.channel = channel
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+        self._last_tag: Union[int, None] = None
+        self._pending = 0
+        self._timer = None
+        self._holds = 0
+
+    def add(self, delivery_tag: int) -> None:
+        """Marks `delivery_tag` as processed, acking the batch if it is full."""
+        # A held message can be added after later ones
+        self._last_tag = delivery_tag if self._last_tag is None else max(self._last_tag, delivery_tag)
+        self._pending += 1
+
+        if self._pending >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.scheduler.call_later(self.batch_timeout, self._on_timeout)
+
+    def flush(self) -> None:
+        """Acks every pending delivery tag at once, unless held."""
+        if self._timer is not None:
+            self.scheduler.remove_timeout(self._timer)
+            self._timer = None
+
+        if self._holds:
+            return
+
+        delivery_tag, self._last_tag, self._pending = self._last_tag, None, 0
+        if delivery_tag is not None and self.channel.is_open:
+            self.channel.basic_ack(delivery_tag, multiple=True)
+
+    def hold(self) -> None:
+        """Stops acking until as many `release` calls."""
+        self._holds += 1
+
+    def release(self) -> None:
+        """Releases a `hold`, acking what was processed meanwhile once none is left."""
+        self._holds -= 1
+        if not self._holds and self._pending:
+            self.flush()
+
+    def _on_timeout(self) -> None:
+        self._timer = None
+        self.flush()
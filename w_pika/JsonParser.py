@@ -0,0 +1,19 @@
+"""JSON parsers for `RabbitMQ(body_parser=..., msg_parser=...)`, backed by `orjson` when
+it's installed and by the standard `json` module otherwise."""
+
+from typing import Any, Callable, Union
+
+json_body_parser: Callable[[Union[str, bytes]], Any]
+json_msg_parser: Callable[[Any], Union[str, bytes]]
+
+try:
+    import orjson
+
+    json_body_parser = orjson.loads
+    # Published as is, bytes don't need to be encoded again
+    json_msg_parser = orjson.dumps
+except ImportError:
+    import json
+
+    json_body_parser = json.loads
+    json_msg_parser = json.dumps
@@ -1,5 +1,4 @@
-import itertools
-from typing import Any, Callable, Iterator
+from typing import Any, Callable, Iterable
 
 from pika import spec
 
@@ -15,6 +14,9 @@ class RabbitConsumerMiddlewareError(RuntimeError):
 
 
 class RabbitConsumerMessage:
+    # One is allocated per delivered message, slots skip the per-instance `__dict__`
+    __slots__ = ("routing_key", "raw_body", "parsed_body", "method", "props")
+
     def __init__(
             self,
             routing_key: str,
@@ -30,25 +32,28 @@ class RabbitConsumerMessage:
         self.props = props
 
     def __str__(self) -> str:
-        return str(self.__dict__)
+        return str({name: getattr(self, name) for name in self.__slots__})
 
 
 def call_middlewares(
-        message: RabbitConsumerMessage, middlewares: Iterator[RabbitConsumerMiddleware]
+        message: RabbitConsumerMessage, middlewares: Iterable[RabbitConsumerMiddleware]
 ) -> None:
     """Calls middlewares with `message`. Each middleware is *expected* to call
     `call_next` once, and exactly once; this is not enforced."""
 
-    middlewares_iter = itertools.chain(middlewares, [lambda message, call_next: None])
+    # Indexed below. The tuple built once per consumer is used as is
+    if not isinstance(middlewares, tuple):
+        middlewares = tuple(middlewares)
+    index = 0
 
     def call_next(message: RabbitConsumerMessage) -> None:
-        try:
-            middleware = next(middlewares_iter)
-        except StopIteration as e:
+        nonlocal index
+        if index > len(middlewares):
             # We can't be 100% sure which middleware did this
-            raise RabbitConsumerMiddlewareError(
-                "Middleware called `call_next` twice."
-            ) from e
-        middleware(message, call_next)
+            raise RabbitConsumerMiddlewareError("Middleware called `call_next` twice.")
+
+        index += 1
+        if index <= len(middlewares):
+            middlewares[index - 1](message, call_next)
 
     call_next(message)
@@ -1,24 +1,29 @@
 import inspect
-import itertools
-import json
 import logging
 import os
+import random
+import time
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from copy import copy
 from datetime import datetime
 from enum import Enum, auto
-from functools import wraps
-from hashlib import sha256
-from threading import Thread
-from typing import Any, Callable, Dict, List, Set, Union
+from functools import lru_cache, wraps
+from hashlib import blake2b
+from threading import Event, Lock, Thread, current_thread
+from typing import Any, Callable, Dict, FrozenSet, List, Set, Tuple, Union
 
-from pika import BlockingConnection, URLParameters, spec
+from pika import BlockingConnection, SelectConnection, URLParameters, spec
 from pika.adapters.blocking_connection import BlockingChannel
-from pika.exceptions import AMQPConnectionError
-from retry import retry
-from retry.api import retry_call
+from pika.adapters.select_connection import IOLoop
+from pika.channel import Channel
+from pika.exceptions import AMQPConnectionError, ChannelClosedByBroker, ChannelClosedByClient
 
+from w_pika.AckBatcher import AckBatcher
 from w_pika.ExchangeParams import ExchangeParams
 from w_pika.ExchangeType import ExchangeType
 from w_pika.QueueParams import QueueParams
+from w_pika.RabbitPublisher import RabbitPublisher
 from w_pika.RabbitConsumerMiddleware import (
     RabbitConsumerMessage,
     RabbitConsumerMiddleware,
@@ -27,6 +32,10 @@ from w_pika.RabbitConsumerMiddleware import (
 
 LOGGER = logging.getLogger(__name__)
 
+# Headers of a failed message published back to its queue
+RETRY_COUNT_HEADER = "x-retry-count"
+RETRY_ROUTING_KEY_HEADER = "x-retry-routing-key"
+
 # (queue_name, dlq_name, method, props, body, exception)
 MessageErrorCallback = Callable[
     [str, Union[str, None], spec.Basic.Deliver, spec.BasicProperties, Union[str, bytes], Exception],
@@ -34,6 +43,31 @@ MessageErrorCallback = Callable[
 ]
 
 
+def backoff_delay(
+        attempt: int, base: float = 1, max_delay: float = 60, jitter: float = 5
+) -> float:
+    """Exponential backoff, in seconds, to wait before retry number `attempt` (from 0)"""
+    return min(max_delay, base * 2 ** min(attempt, 32)) + random.uniform(0, jitter)
+
+
+def _warn_exchange_type():
+    warnings.warn(
+        "`exchange_type` is ignored when sending, the exchange's type is `MQ_EXCHANGE_TYPE` or the consumers' one",
+        DeprecationWarning,
+        stacklevel=3,
+    )
+
+
+def run_in_order(steps: List[Callable[[Callable], None]], on_done: Callable[[], None]):
+    """Runs asynchronous channel calls one after the other. Each step is called with the
+    callback its call should complete with, `on_done` is called after the last one."""
+    if not steps:
+        on_done()
+        return
+
+    steps[0](lambda _frame: run_in_order(steps[1:], on_done))
+
+
 class OptionalProps(Enum):
     """Props that can be optionally passed to functions decorated by @queue."""
 
@@ -42,17 +76,42 @@ class OptionalProps(Enum):
     message_version = auto()
 
 
+PropsExtractor = Callable[[spec.BasicProperties], Dict[str, Any]]
+
+# How every optional prop is read from the message properties
+PROPS_GETTERS: Dict[str, Callable[[spec.BasicProperties], Any]] = {
+    OptionalProps.message_id.name: lambda props: props.message_id,
+    OptionalProps.sent_at.name: lambda props: datetime.fromtimestamp(props.timestamp),
+    OptionalProps.message_version.name: lambda props: props.headers.get("x-message-version"),
+}
+
+
+def make_props_extractor(props_needed: FrozenSet[str]) -> PropsExtractor:
+    """Builds the function returning the `props_needed` of a message. It's built once per
+    consumer, so nothing is looked up in `props_needed` for each message."""
+    getters = tuple(
+        (name, getter) for name, getter in PROPS_GETTERS.items() if name in props_needed
+    )
+    if not getters:
+        return lambda props: {}
+
+    return lambda props: {name: getter(props) for name, getter in getters}
+
+
 class RabbitMQ:
     """Main class containing queue and message sending methods"""
 
     get_connection: Callable[[], BlockingConnection]
-    consumers: Set[Callable[[], None]]
+    consumers: List[Callable[[SelectConnection], None]]
 
     body_parser: Callable
     msg_parser: Callable
 
     exchange_name: str
+    exchange_type: ExchangeType
     exchange_params: ExchangeParams
+    _configured_exchange_type: Union[ExchangeType, None]
+    _consumer_exchange_type: Union[ExchangeType, None]
 
     queue_prefix: str
     queue_params: QueueParams
@@ -60,6 +119,18 @@ class RabbitMQ:
     on_message_error_callback: Union[MessageErrorCallback, None]
     middlewares: List[RabbitConsumerMiddleware]
 
+    _ioloop: IOLoop
+    _ioloop_thread: Union[Thread, None]
+
+    _publisher: Union[RabbitPublisher, None]
+    _unconfirmed_sends: Set[Future]
+
+    _consumer_connection: Union[SelectConnection, None]
+
+    _declared_exchanges: Set[str]
+    _exchange_waiters: Dict[str, List[Tuple[Channel, Callable, Callable]]]
+    _consumer_states: List[Dict[str, Any]]
+
     def __init__(
             self,
             config: Union[Dict, None] = None,
@@ -74,12 +145,38 @@ class RabbitMQ:
             default_send_properties: Union[Dict[str, Any], None] = None,
     ) -> None:
         self.config = config
-        self.consumers = set()
+        # Started in registration order, so channels open deterministically
+        self.consumers = []
+        # The exchange has a single type, set by `MQ_EXCHANGE_TYPE` or the consumers
+        self._configured_exchange_type = None
+        self._consumer_exchange_type = None
         self.exchange_params = exchange_params
         self.queue_params = queue_params
         self.middlewares = middlewares or []
         self.default_send_properties = default_send_properties or {}
 
+        # Both the consumer and the publisher connection run on this loop, in one IO thread
+        self._ioloop = IOLoop()
+        self._ioloop_thread = None
+        self._ioloop_lock = Lock()
+
+        self._publisher = None
+        self._unconfirmed_sends = set()
+        self._sends_lock = Lock()
+
+        # Exchanges known to exist, declared once rather than by every channel
+        self._declared_exchanges = set()
+        self._exchange_lock = Lock()
+        # (channel, declare, callback) of consumer channels waiting for a declaration in progress,
+        # IO thread only
+        self._exchange_waiters = {}
+
+        self._consumer_connection = None
+        self._consumer_attempt = 0
+        self._consumer_states = []
+        self._consumers_started = False
+        self._stopping = False
+
         self.init_app(
             queue_prefix,
             body_parser,
@@ -114,6 +211,10 @@ class RabbitMQ:
         self.msg_parser = msg_parser or (lambda msg: msg)
         self.on_message_error_callback = on_message_error_callback
         self.middlewares.extend(middlewares or [])
+        self._spacer = self.config.get("MQ_DELIMITER", ".")
+
+        # Template every sent message's properties are merged into
+        self._base_properties = dict(self.default_send_properties)
 
         exchange_name = self.config.get("MQ_EXCHANGE") or os.getenv("MQ_EXCHANGE")
         assert (
@@ -126,48 +227,195 @@ class RabbitMQ:
             "MQ_URL not set. Please define the RabbitMQ url using this format: "
             "https://pika.readthedocs.io/en/stable/examples/using_urlparameters.html"
         )
-        params = URLParameters(mq_url)
-        self.get_connection = lambda: BlockingConnection(params)
+        self._params = URLParameters(mq_url)
+        self.get_connection = lambda: BlockingConnection(self._params)
+
+        exchange_type = self.config.get("MQ_EXCHANGE_TYPE") or os.getenv("MQ_EXCHANGE_TYPE")
+        self._configured_exchange_type = ExchangeType(exchange_type) if exchange_type else None
+        self._check_exchange_type(self._consumer_exchange_type)
+        self.exchange_type = (
+            self._configured_exchange_type or self._consumer_exchange_type or ExchangeType.DEFAULT
+        )
 
         self._validate_connection()
 
-        # Run every consumer queue
-        for consumer in self.consumers:
-            consumer()
+        if self._publisher is None:
+            self._publisher = RabbitPublisher(
+                self._params, self._ioloop, self._on_publisher_channel_open
+            )
+
+        # Run every consumer queue, once
+        if self.consumers and not self._consumers_started:
+            self._consumers_started = True
+            self._ioloop.add_callback_threadsafe(self._connect_consumers)
+            self._start_ioloop()
+
+    def _check_exchange_type(self, exchange_type: Union[ExchangeType, None]):
+        """Raises if `exchange_type` isn't the one the exchange is already declared with"""
+        known_type = self._configured_exchange_type or self._consumer_exchange_type
+        if exchange_type is not None and known_type is not None and exchange_type is not known_type:
+            raise ValueError(
+                f"Exchange {self.exchange_name} is a {known_type.value} exchange, "
+                f"it can't be declared as a {exchange_type.value} one"
+            )
 
     def _validate_connection(self):
+        """Checks the connection and declares the exchange once, so publishes don't have to.
+
+        Its type is only known here when set by `MQ_EXCHANGE_TYPE`, consumers are registered
+        later. Otherwise it's only checked, and left for the consumers or the publisher to declare."""
         try:
             connection = self.get_connection()
-            if connection.is_open:
-                LOGGER.info("Connected to RabbitMQ")
-                connection.close()
         except Exception as error:  # pylint: disable=broad-except
             LOGGER.error("Invalid RabbitMQ connection")
             LOGGER.error(error.__class__.__name__)
+            return
+
+        try:
+            LOGGER.info("Connected to RabbitMQ")
+            channel = connection.channel()
+            if self._configured_exchange_type or self._consumer_exchange_type:
+                self._declare_exchange(channel, self.exchange_type)
+            else:
+                channel.exchange_declare(exchange=self.exchange_name, passive=True)
+            self._set_exchange_declared(self.exchange_name)
+        except ChannelClosedByBroker as error:
+            if error.reply_code == 404:
+                LOGGER.info(f"Exchange {self.exchange_name} doesn't exist yet, it's declared on first use")
+            else:
+                LOGGER.error(f"Could not declare exchange {self.exchange_name}: {error!r}")
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.error(f"Could not declare exchange {self.exchange_name}: {error!r}")
+        finally:
+            if connection.is_open:
+                connection.close()
+
+    def _declare_exchange(
+            self,
+            channel: Union[BlockingChannel, Channel],
+            exchange_type: ExchangeType,
+            **kwargs,
+    ):
+        """Declares the main exchange with `exchange_params`. `kwargs`, such as the
+        `callback` of an asynchronous channel, are passed to `exchange_declare`."""
+        channel.exchange_declare(
+            exchange=self.exchange_name,
+            exchange_type=exchange_type.value,
+            passive=self.exchange_params.passive,
+            durable=self.exchange_params.durable,
+            auto_delete=self.exchange_params.auto_delete,
+            internal=self.exchange_params.internal,
+            **kwargs,
+        )
+
+    def _is_exchange_declared(self, exchange: str) -> bool:
+        with self._exchange_lock:
+            return exchange in self._declared_exchanges
+
+    def _set_exchange_declared(self, exchange: str):
+        with self._exchange_lock:
+            self._declared_exchanges.add(exchange)
+
+    def _declare_exchange_once(
+            self,
+            channel: Channel,
+            exchange: str,
+            declare: Callable[[Callable], None],
+            callback: Callable,
+    ):
+        """Declares `exchange` by calling `declare` with its completion callback, unless it's
+        already declared or being declared by another consumer channel. `callback` is called
+        once the exchange exists. Runs on the IO thread.
+
+        Should the declaring `channel` be closed first, e.g. on a type mismatch, the next
+        waiting channel still open declares it instead."""
+        if self._is_exchange_declared(exchange):
+            callback(None)
+            return
+
+        waiters = self._exchange_waiters.get(exchange)
+        if waiters is not None:
+            waiters.append((channel, declare, callback))
+            return
+
+        waiters = self._exchange_waiters[exchange] = [(channel, declare, callback)]
+
+        def on_declared(frame):
+            self._set_exchange_declared(exchange)
+            for _channel, _declare, waiter in self._exchange_waiters.pop(exchange):
+                waiter(frame)
+
+        def on_closed(*_):
+            # Only if this declaration is still in progress
+            if self._exchange_waiters.get(exchange) is not waiters:
+                return
+
+            del self._exchange_waiters[exchange]
+            for waiter in waiters[1:]:
+                if waiter[0].is_open:
+                    self._declare_exchange_once(waiter[0], exchange, *waiter[1:])
+
+        channel.add_on_close_callback(on_closed)
+        declare(on_declared)
+
+    def _is_topology_durable(self) -> bool:
+        """If the exchange and queues outlive both their consumers and a broker restart"""
+        return (
+            self.exchange_params.durable
+            and not self.exchange_params.auto_delete
+            and self.queue_params.durable
+            and not self.queue_params.auto_delete
+            and not self.queue_params.exclusive
+        )
 
     def _build_queue_name(self, func: Callable):
         """Builds queue name from function name"""
-        spacer = self.config["MQ_DELIMITER"] if "MQ_DELIMITER" in self.config else "."
-        return self.queue_prefix + spacer + func.__name__.replace("_", spacer)
+        return self._build_qname(self.queue_prefix, self._spacer, func.__name__)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _build_qname(prefix: str, spacer: str, fname: str) -> str:
+        return prefix + spacer + fname.replace("_", spacer)
 
     def queue(
             self,
             routing_key: Union[str, List[str]],
-            exchange_type: ExchangeType = ExchangeType.DEFAULT,
+            exchange_type: Union[ExchangeType, None] = None,
             auto_ack: bool = False,
             dead_letter_exchange: bool = False,
             props_needed: List[str] | None = None,
+            ack_batch_size: int = 50,
+            ack_batch_timeout: float = 0.1,
+            prefetch_count: int = 100,
+            max_retries: int = 1,
     ):
         """Creates new RabbitMQ queue
 
         Args:
             routing_key (str | list[str]): The routing key(s) for this queue
-            exchange_type (ExchangeType, optional): The exchange type to be used. Defaults to TOPIC.
+            exchange_type (ExchangeType, optional): The exchange type to be used, shared by every consumer.
+                Raises a ValueError when it's not `MQ_EXCHANGE_TYPE` or another consumer's one.
+                Defaults to the exchange's type, TOPIC when it's set nowhere.
             auto_ack (bool, optional): If messages should be auto acknowledged. Defaults to False
             dead_letter_exchange (bool): If a dead letter exchange should be created for this queue
             props_needed (list[str], optional): List of properties to be passed along with body, such as `sent_at` or `message_id`. Defaults to None.
+            ack_batch_size (int, optional): Number of processed messages acked at once with a single `basic_ack`.
+                Lowered to `prefetch_count` when above it, batches would otherwise only be acked on timeout. Defaults to 50
+            ack_batch_timeout (float, optional): Max seconds a processed message waits for its batch to be acked. Defaults to 0.1
+            prefetch_count (int, optional): Max number of unacked messages delivered to this consumer, 0 means unlimited.
+                Defaults to 100
+            max_retries (int, optional): Times a failed message is published back to this queue before it's rejected
+                to the dead letter exchange, counted in its `x-retry-count` header. Defaults to 1
         """
 
+        if prefetch_count:
+            ack_batch_size = min(ack_batch_size, prefetch_count)
+
+        # Checked now rather than on the IO thread, where a mismatch would close channels in a loop
+        self._check_exchange_type(exchange_type)
+        if exchange_type is not None:
+            self._consumer_exchange_type = self.exchange_type = exchange_type
+
         def decorator(f):
             # ignore flask default reload when on debug mode
             nonlocal props_needed
@@ -177,334 +425,682 @@ class RabbitMQ:
                     prop.name for prop in OptionalProps if prop.name in f_signature
                 ]
 
+            props_extractor = make_props_extractor(frozenset(props_needed or []))
+
+            # Kept across reconnects of the shared consumer connection
+            state = {"declared": False, "worker": None, "retry_failures": 0, "requeues": set()}
+            # A single worker keeps the messages of a queue processed in order
+            state["executor"] = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f.__name__,
+                initializer=lambda: state.update(worker=current_thread()),
+            )
+
             @wraps(f)
-            def new_consumer():
-                return self._setup_connection(
+            def new_consumer(connection: SelectConnection):
+                return self._add_exchange_queue(
+                    connection,
                     f,
                     routing_key,
-                    exchange_type,
                     auto_ack,
                     dead_letter_exchange,
-                    props_needed or [],
+                    props_extractor,
+                    ack_batch_size,
+                    ack_batch_timeout,
+                    prefetch_count,
+                    max_retries,
+                    state,
                 )
 
-            self.consumers.add(new_consumer)
+            self.consumers.append(new_consumer)
+            self._consumer_states.append(state)
             return f
 
         return decorator
 
-    def _setup_connection(
-            self,
-            func: Callable,
-            routing_key: Union[str, List[str]],
-            exchange_type: ExchangeType,
-            auto_ack: bool,
-            dead_letter_exchange: bool,
-            props_needed: List[str],
-    ):
-        """Setup new queue connection in a new thread
+    def _start_ioloop(self):
+        """Starts the IO thread, at the latest when the first consumer or message needs it"""
+        with self._ioloop_lock:
+            if self._ioloop_thread is None:
+                self._ioloop_thread = Thread(target=self._ioloop.start, name="w_pika-io")
+                self._ioloop_thread.daemon = True
+                self._ioloop_thread.start()
+
+    def _connect_consumers(self):
+        """Runs every consumer on one shared connection"""
+        if self._stopping:
+            return
+
+        self._consumer_connection = SelectConnection(
+            self._params,
+            on_open_callback=self._on_consumer_connection_open,
+            on_open_error_callback=self._on_consumer_connection_closed,
+            on_close_callback=self._on_consumer_connection_closed,
+            custom_ioloop=self._ioloop,
+        )
+
+    def _on_consumer_connection_open(self, connection: SelectConnection):
+        LOGGER.info("Consumer connection opened")
+        self._consumer_attempt = 0
+
+        # Non-durable exchanges may not have survived the outage, redeclare them once
+        with self._exchange_lock:
+            self._declared_exchanges.clear()
+        self._exchange_waiters.clear()
+
+        # Every consumer gets its own channel on this connection
+        for consumer in self.consumers:
+            consumer(connection)
+
+    def _on_consumer_connection_closed(self, _: SelectConnection, error: Exception):
+        if self._stopping:
+            LOGGER.info("Consumer connection closed")
+            return
+
+        delay = backoff_delay(self._consumer_attempt)
+        self._consumer_attempt += 1
+        LOGGER.warning(f"Consumer connection lost ({error!r}), reconnecting in {delay:.1f}s")
+        self._ioloop.call_later(delay, self._connect_consumers)
+
+    def stop(self, timeout: float = 30):
+        """Gracefully stops consuming and publishing. Deliveries are cancelled, the messages
+        being processed are finished and acked, and sent messages are confirmed before
+        both connections are closed. Prefetched messages not processed yet are redelivered.
+
+        It can be called from a consumer, which is then not waited for, but not from the IO thread.
 
         Args:
-            func (Callable): function to run as callback for a new message
-            routing_key (str | list[str]): routing key(s) for the new queue bind
-            exchange_type (ExchangeType): Exchange type to be used with new queue
-            auto_ack (bool): If messages should be auto acknowledged.
-            dead_letter_exchange (bool): If a dead letter exchange should be created for this queue
-            props_needed (list[str]): List of properties to be passed along with body
+            timeout (float, optional): Max seconds to wait for each step of the shutdown. Defaults to 30
         """
 
-        def create_queue():
-            return self._add_exchange_queue(
-                func,
-                routing_key,
-                exchange_type,
-                auto_ack,
-                dead_letter_exchange,
-                props_needed,
-            )
-
-        thread = Thread(target=create_queue, name=self._build_queue_name(func))
-        thread.daemon = True
-        thread.start()
+        if current_thread() is self._ioloop_thread:
+            raise RuntimeError("`stop` can't be called from the IO thread")
 
-    @staticmethod
-    def __get_needed_props(props_needed: List[str], props: spec.BasicProperties):
-        """Sets needed properties for a message"""
+        self._stopping = True
+        if self._ioloop_thread is None:
+            return
 
-        payload = {}
+        self._run_on_ioloop(self._cancel_consumers, timeout)
 
-        if "message_id" in props_needed:
-            payload["message_id"] = props.message_id
+        # Queued messages are dropped, the ones being processed are finished. `shutdown` can't
+        # be bounded, so it's joined from helper threads instead
+        deadline = time.monotonic() + timeout
+        joiners = []
+        for state in self._consumer_states:
+            if state["worker"] is current_thread():
+                state["executor"].shutdown(wait=False, cancel_futures=True)
+                continue
 
-        if "sent_at" in props_needed:
-            payload["sent_at"] = datetime.fromtimestamp(props.timestamp)
+            joiner = Thread(
+                target=state["executor"].shutdown,
+                kwargs={"wait": True, "cancel_futures": True},
+            )
+            joiner.daemon = True
+            joiner.start()
+            joiners.append(joiner)
+        for joiner in joiners:
+            joiner.join(max(0, deadline - time.monotonic()))
+
+        # Includes the messages sent, and the retries of the ones that failed, while processing
+        # the messages above. Held acks are only flushed once their retries are settled
+        with self._sends_lock:
+            sends = list(self._unconfirmed_sends)
+        wait(sends, timeout)
+
+        # Runs after the acks queued by the executors above
+        self._ioloop.add_callback_threadsafe(self._close_connections)
+        self._ioloop_thread.join(timeout)
+
+    def _run_on_ioloop(self, callback: Callable[[], None], timeout: float):
+        """Runs `callback` on the IO thread and waits for it to return"""
+        done = Event()
+
+        def run():
+            try:
+                callback()
+            finally:
+                done.set()
+
+        self._ioloop.add_callback_threadsafe(run)
+        done.wait(timeout)
+
+    def _cancel_consumers(self):
+        for state in self._consumer_states:
+            channel = state.get("channel")
+            # No consumer tag while the topology is still being declared
+            consumer_tag = state.get("consumer_tag")
+            if channel is not None and channel.is_open and consumer_tag is not None:
+                channel.basic_cancel(consumer_tag)
+
+            # Failed retries waiting for their backoff are requeued now, `stop` waits for them
+            for requeue in list(state["requeues"]):
+                requeue()
+
+    def _close_connections(self):
+        connection = self._consumer_connection
+        if connection is not None and connection.is_open:
+            for state in self._consumer_states:
+                if state.get("ack_batcher") is not None:
+                    state["ack_batcher"].flush()
+            connection.close()
 
-        if "message_version" in props_needed:
-            payload["message_version"] = props.headers.get("x-message-version")
+        self._publisher.close()
+        self._stop_ioloop_when_closed()
 
-        return payload
+    def _stop_ioloop_when_closed(self):
+        connection = self._consumer_connection
+        if (connection is None or connection.is_closed) and self._publisher.is_closed:
+            self._ioloop.stop()
+        else:
+            self._ioloop.call_later(0.05, self._stop_ioloop_when_closed)
 
-    @retry((AMQPConnectionError, AssertionError), delay=5, jitter=(5, 15))
     def _add_exchange_queue(
             self,
+            connection: SelectConnection,
             func: Callable,
             routing_key: Union[str, List[str]],
-            exchange_type: ExchangeType,
             auto_ack: bool,
             dead_letter_exchange: bool,
-            props_needed: List[str],
+            props_extractor: PropsExtractor,
+            ack_batch_size: int,
+            ack_batch_timeout: float,
+            prefetch_count: int,
+            max_retries: int,
+            state: Dict[str, Any],
     ):
-        """Creates or connects to new queue, retries connection on failure
+        """Opens a channel on `connection`, creates or connects to the queue and consumes from it.
+        Runs on the IO thread, messages are handed to the consumer's own worker thread.
 
         Args:
+            connection (SelectConnection): the shared consumer connection
             func (Callable): function to run as callback for a new message
             routing_key (str | list[str]): routing key(s) for the new queue bind
-            exchange_type (ExchangeType): Exchange type to be used with new queue
             auto_ack (bool): If messages should be auto acknowledged.
             dead_letter_exchange (bool): If a dead letter exchange should be created for this queue
-            props_needed (list[str]): List of properties to be passed along with body
+            props_extractor (PropsExtractor): Returns the properties to be passed along with body
+            ack_batch_size (int): Number of processed messages acked at once
+            ack_batch_timeout (float): Max seconds a processed message waits for its batch to be acked
+            prefetch_count (int): Max number of unacked messages delivered to this consumer
+            max_retries (int): Times a failed message is published back to this queue before it's rejected
+            state (dict[str, Any]): Reconnect state, `declared` once every exchange, queue and bind
+                was created and the `executor` running `func`, along with the current `channel`,
+                `ack_batcher` and `consumer_tag` used by `stop`, and the `attempt` at reopening a channel
+                closed by the broker
         """
 
-        # Create connection channel
-        connection = self.get_connection()
-        channel = connection.channel()
-
-        # declare dead letter exchange if needed
-        dead_letter_exchange_name = f"dead.letter.{self.exchange_name}"
-        if dead_letter_exchange:
-            channel.exchange_declare(
-                dead_letter_exchange_name, ExchangeType.DIRECT.value
-            )
+        ioloop = connection.ioloop
+        executor = state["executor"]
 
-        # Declare exchange
-        channel.exchange_declare(
-            exchange=self.exchange_name,
-            exchange_type=exchange_type.value,
-            passive=self.exchange_params.passive,
-            durable=self.exchange_params.durable,
-            auto_delete=self.exchange_params.auto_delete,
-            internal=self.exchange_params.internal,
-        )
-
-        # Creates new queue or connects to existing one
         queue_name = self._build_queue_name(func)
-        exchange_args = {}
+        dead_letter_exchange_name = f"dead.letter.{self.exchange_name}"
         dead_letter_queue_name = None
         if dead_letter_exchange:
             dead_letter_queue_name = f"dead.letter.{queue_name}"
-            channel.queue_declare(
-                dead_letter_queue_name,
-                durable=self.queue_params.durable,
-            )
-
-            # Bind queue to exchange
-            channel.queue_bind(
-                exchange=dead_letter_exchange_name,
-                queue=dead_letter_queue_name,
-                routing_key=dead_letter_queue_name,
-            )
-
-            exchange_args = {
-                "x-dead-letter-exchange": dead_letter_exchange_name,
-                "x-dead-letter-routing-key": dead_letter_queue_name,
-            }
-
-        channel.queue_declare(
-            queue_name,
-            passive=self.queue_params.passive,
-            durable=self.queue_params.durable,
-            auto_delete=self.queue_params.auto_delete,
-            exclusive=self.queue_params.exclusive,
-            arguments=exchange_args,
-        )
-        LOGGER.info(f"Declaring Queue: {queue_name}")
-
-        # Bind queue to exchange
-        routing_keys = routing_key if isinstance(routing_key, list) else [routing_key]
-        for routing_key in routing_keys:
-            channel.queue_bind(
-                exchange=self.exchange_name, queue=queue_name, routing_key=routing_key
-            )
 
         def user_consumer(message: RabbitConsumerMessage, call_next) -> None:
             """User consumer as a middleware. Calls the consumer `func`."""
             func(
                 routing_key=message.routing_key,
                 body=message.parsed_body,
-                **RabbitMQ.__get_needed_props(props_needed, message.props),
+                **props_extractor(message.props),
             )
             call_next(message)
 
-        def callback(
-                _: BlockingChannel,
-                method: spec.Basic.Deliver,
-                props: spec.BasicProperties,
-                body: bytes,
-        ):
-            try:
-                # Fetches original message routing_key from headers if it has been dead-lettered
-                routing_key = method.routing_key
-
-                if getattr(props, "headers", None) and props.headers.get("x-death"):
-                    x_death_props = props.headers.get("x-death")[0]
-                    routing_key = x_death_props.get("routing-keys")[0]
-
-                message = RabbitConsumerMessage(
-                    routing_key, body, self.body_parser(body), method, props
-                )
-                call_middlewares(
-                    message,
-                    itertools.chain(list(self.middlewares), [user_consumer]),
+        # Built once, rather than chaining the middlewares for every message
+        pipeline = tuple(self.middlewares) + (user_consumer,)
+
+        def declare_topology(channel: Channel) -> List[Callable[[Callable], None]]:
+            """Steps declaring every exchange, queue and bind needed by this consumer"""
+            steps = []
+
+            # declare dead letter exchange if needed
+            if dead_letter_exchange:
+                steps.append(lambda cb: self._declare_exchange_once(
+                    channel,
+                    dead_letter_exchange_name,
+                    lambda on_declared: channel.exchange_declare(
+                        dead_letter_exchange_name, ExchangeType.DIRECT.value, callback=on_declared
+                    ),
+                    cb,
+                ))
+
+            # Declare exchange
+            steps.append(lambda cb: self._declare_exchange_once(
+                channel,
+                self.exchange_name,
+                lambda on_declared: self._declare_exchange(
+                    channel, self.exchange_type, callback=on_declared
+                ),
+                cb,
+            ))
+
+            # Creates new queue or connects to existing one
+            exchange_args = {}
+            if dead_letter_exchange:
+                steps.append(lambda cb: channel.queue_declare(
+                    dead_letter_queue_name,
+                    durable=self.queue_params.durable,
+                    callback=cb,
+                ))
+
+                # Bind queue to exchange
+                steps.append(lambda cb: channel.queue_bind(
+                    queue=dead_letter_queue_name,
+                    exchange=dead_letter_exchange_name,
+                    routing_key=dead_letter_queue_name,
+                    callback=cb,
+                ))
+
+                exchange_args = {
+                    "x-dead-letter-exchange": dead_letter_exchange_name,
+                    "x-dead-letter-routing-key": dead_letter_queue_name,
+                }
+
+            steps.append(lambda cb: channel.queue_declare(
+                queue_name,
+                passive=self.queue_params.passive,
+                durable=self.queue_params.durable,
+                auto_delete=self.queue_params.auto_delete,
+                exclusive=self.queue_params.exclusive,
+                arguments=exchange_args,
+                callback=cb,
+            ))
+
+            # Bind queue to exchange. Every bind but the last is sent without waiting for its
+            # Bind-Ok (nowait), the broker handles a channel's methods in order so the last
+            # Bind-Ok covers them all: one round trip whatever the number of keys
+            routing_keys = routing_key if isinstance(routing_key, list) else [routing_key]
+
+            def bind(cb):
+                for key in routing_keys[:-1]:
+                    channel.queue_bind(queue=queue_name, exchange=self.exchange_name, routing_key=key)
+                channel.queue_bind(
+                    queue=queue_name, exchange=self.exchange_name, routing_key=routing_keys[-1], callback=cb
                 )
 
-                if not auto_ack:
-                    # ack message after fn was ran
-                    channel.basic_ack(method.delivery_tag)
-            except Exception as err:  # pylint: disable=broad-except
-                LOGGER.error(f"ERROR IN {queue_name}: {err}")
-                LOGGER.exception(err)
+            if routing_keys:
+                steps.append(bind)
+
+            return steps
+
+        def on_channel_open(channel: Channel):
+            channel.add_on_close_callback(on_channel_closed)
+            ack_batcher = AckBatcher(channel, ioloop, ack_batch_size, ack_batch_timeout)
+            state["channel"], state["ack_batcher"] = channel, ack_batcher
+            state["consumer_tag"] = None
+
+            def retry_or_reject(
+                    method: spec.Basic.Deliver,
+                    props: spec.BasicProperties,
+                    body: bytes,
+                    routing_key: str,
+                    settled: Future,
+            ):
+                """Publishes a failed message back to the queue with its retry count increased,
+                or rejects it to the dead letter exchange once out of retries. Runs on the IO thread.
+
+                The retry goes through the publisher, and the message is only acked once the broker
+                confirmed it. Should it fail, the message is requeued as is instead, after a backoff
+                so it isn't redelivered and failed again in a loop while the publisher is down.
+                `settled` is resolved once the message is acked or rejected."""
+                if not channel.is_open:
+                    settled.set_result(None)
+                    return
+
+                headers = props.headers or {}
+                try:
+                    retry_count = int(headers.get(RETRY_COUNT_HEADER, 0))
+                except (TypeError, ValueError):
+                    # Not set by us, raising here would stop the IO thread
+                    retry_count = 0
+
+                if retry_count < max_retries:
+                    retry_props = copy(props)
+                    retry_props.headers = {
+                        **headers,
+                        RETRY_COUNT_HEADER: retry_count + 1,
+                        RETRY_ROUTING_KEY_HEADER: routing_key,
+                    }
+
+                    def requeue():
+                        # Called by its timer, or earlier by `_cancel_consumers`
+                        if requeue not in state["requeues"]:
+                            return
+                        state["requeues"].remove(requeue)
+                        if channel.is_open:
+                            channel.basic_reject(method.delivery_tag, requeue=True)
+                        ack_batcher.release()
+                        settled.set_result(None)
+
+                    def on_confirm(confirm: Future):
+                        # Resolved on the IO thread
+                        if confirm.exception() is None:
+                            state["retry_failures"] = 0
+                            ack_batcher.add(method.delivery_tag)
+                            ack_batcher.release()
+                            settled.set_result(None)
+                            return
+
+                        # The hold is kept until it's requeued
+                        state["requeues"].add(requeue)
+                        if self._stopping:
+                            requeue()
+                            return
+
+                        delay = backoff_delay(state["retry_failures"])
+                        state["retry_failures"] += 1
+                        LOGGER.error(
+                            f"Retry of a message of {queue_name} failed ({confirm.exception()!r}), "
+                            f"requeuing it in {delay:.1f}s"
+                        )
+                        ioloop.call_later(delay, requeue)
+
+                    # A multiple ack of the next messages would ack this one before its retry is confirmed
+                    ack_batcher.hold()
+                    # The default exchange routes it to this queue only
+                    self._publisher.publish(
+                        "", queue_name, body, retry_props
+                    ).add_done_callback(on_confirm)
+                    return
+
+                # ack what was processed before this message first, so acks
+                # and rejects reach the broker in delivery order
+                ack_batcher.flush()
+                channel.basic_reject(method.delivery_tag, requeue=False)
+                settled.set_result(None)
+
+            def process(
+                    method: spec.Basic.Deliver,
+                    props: spec.BasicProperties,
+                    body: bytes,
+            ):
+                """Processes a message, runs on the consumer's worker thread"""
+                if not auto_ack and not channel.is_open:
+                    # Its ack can't be sent anymore, the broker delivers it again
+                    return
 
                 try:
+                    # Fetches original message routing_key from headers if it has been published
+                    # back for a retry or dead-lettered. A retried message is dead-lettered with
+                    # the queue name as routing key, so the retry header comes first
+                    routing_key = method.routing_key
+
+                    headers = props.headers
+                    if headers is not None:
+                        if RETRY_ROUTING_KEY_HEADER in headers:
+                            routing_key = headers[RETRY_ROUTING_KEY_HEADER]
+                        else:
+                            x_death = headers.get("x-death")
+                            if x_death:
+                                routing_key = x_death[0]["routing-keys"][0]
+
+                    message = RabbitConsumerMessage(
+                        routing_key, body, self.body_parser(body), method, props
+                    )
+                    call_middlewares(message, pipeline)
+
                     if not auto_ack:
-                        channel.basic_reject(
-                            method.delivery_tag, requeue=(not method.redelivered)
+                        # ack message after fn was ran, batched with its neighbours
+                        ioloop.add_callback_threadsafe(
+                            lambda: ack_batcher.add(method.delivery_tag)
                         )
-                finally:
-                    if self.on_message_error_callback is not None:
-                        self.on_message_error_callback(
-                            queue_name,
-                            dead_letter_queue_name,
-                            method,
-                            props,
-                            body,
-                            err,
-                        )
-
-        channel.basic_consume(
-            queue=queue_name, on_message_callback=callback, auto_ack=auto_ack
-        )
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.error(f"ERROR IN {queue_name}: {err}")
+                    LOGGER.exception(err)
+
+                    try:
+                        if not auto_ack:
+                            # Tracked before the IO thread gets to it, so `stop` waits for it
+                            settled = self._track_send(Future())
+                            ioloop.add_callback_threadsafe(
+                                lambda: retry_or_reject(method, props, body, routing_key, settled)
+                            )
+                    finally:
+                        if self.on_message_error_callback is not None:
+                            self.on_message_error_callback(
+                                queue_name,
+                                dead_letter_queue_name,
+                                method,
+                                props,
+                                body,
+                                err,
+                            )
+
+            def callback(
+                    _: Channel,
+                    method: spec.Basic.Deliver,
+                    props: spec.BasicProperties,
+                    body: bytes,
+            ):
+                if self._stopping:
+                    # Delivered before the cancel, the executor may be shut down already
+                    return
+                executor.submit(process, method, props, body)
+
+            def start_consuming():
+                if self._stopping:
+                    return
+
+                state["attempt"] = 0
+                if not state["declared"]:
+                    LOGGER.info(f"Declared Queue: {queue_name}")
+                    # Only topology surviving a broker restart can be skipped on reconnect
+                    state["declared"] = not dead_letter_exchange and self._is_topology_durable()
+
+                state["consumer_tag"] = channel.basic_consume(
+                    queue=queue_name, on_message_callback=callback, auto_ack=auto_ack
+                )
 
-        try:
-            channel.start_consuming()
-        except Exception as err:
-            LOGGER.error(err)
-            channel.stop_consuming()
-            connection.close()
+            # Bound the in-flight messages pulled by this consumer
+            steps = [lambda cb: channel.basic_qos(
+                prefetch_count=prefetch_count, global_qos=False, callback=cb
+            )]
+            if not state["declared"]:
+                steps.extend(declare_topology(channel))
+
+            run_in_order(steps, start_consuming)
+
+        def reopen_channel():
+            if connection.is_open and not self._stopping:
+                connection.channel(on_open_callback=on_channel_open)
+
+        def on_channel_closed(_: Channel, reason: Exception):
+            # Closing the connection closes its channels too, it's reopened by the reconnect
+            if not connection.is_open or self._stopping:
+                return
+
+            # Closed by the broker, e.g. an ack timeout or a queue arguments mismatch
+            delay = backoff_delay(state["attempt"])
+            state["attempt"] += 1
+            LOGGER.error(f"Channel of {queue_name} closed ({reason!r}), reopening in {delay:.1f}s")
+            ioloop.call_later(delay, reopen_channel)
+
+        state["attempt"] = 0
+        connection.channel(on_open_callback=on_channel_open)
+
+    def _on_publisher_channel_open(self, channel: Channel, on_ready: Callable[[], None]):
+        """Makes sure the exchange exists before publishing on a new publisher channel. It's
+        checked once per publisher connection, since a non durable exchange doesn't survive a
+        broker restart and the consumer connection, which otherwise redeclares it, may not exist.
+
+        It's only declared when missing, so a type set by consumers registered after the
+        publisher connected isn't overridden. The check runs on its own channel since a failed
+        passive declare closes it."""
+
+        def on_declared(_frame):
+            self._set_exchange_declared(self.exchange_name)
+            on_ready()
+
+        def on_check_closed(_: Channel, reason: Exception):
+            if not channel.is_open or isinstance(reason, ChannelClosedByClient):
+                return
+            if isinstance(reason, ChannelClosedByBroker) and reason.reply_code == 404:
+                self._declare_exchange(channel, self.exchange_type, callback=on_declared)
+            else:
+                # Fails the messages waiting for it, the next publish reconnects
+                channel.close()
+
+        def on_exists(check: Channel):
+            if check.is_open:
+                check.close()
+            on_declared(None)
+
+        def on_check_open(check: Channel):
+            check.add_on_close_callback(on_check_closed)
+            check.exchange_declare(
+                exchange=self.exchange_name, passive=True, callback=lambda _: on_exists(check)
+            )
 
-            raise AMQPConnectionError from err
+        channel.connection.channel(on_open_callback=on_check_open)
 
-    def _send_msg(
+    def _build_message(
             self,
             body,
-            routing_key,
-            exchange_type,
             message_version: str = "v1.0.0",
             **properties,
+    ) -> Tuple[Union[str, bytes], spec.BasicProperties]:
+        """Parses the body to be sent and builds its properties"""
+        if self.msg_parser:
+            body = self.msg_parser(body)
+
+        properties = {**self._base_properties, **properties}
+
+        if "message_id" not in properties:
+            # Hash the already serialized body instead of dumping it again
+            properties["message_id"] = blake2b(
+                body.encode("utf-8") if isinstance(body, str) else body,
+                digest_size=16,
+            ).hexdigest()
+        if "timestamp" not in properties:
+            properties["timestamp"] = int(time.time())
+
+        # Copied, so neither the default nor the caller's headers are modified
+        properties["headers"] = {
+            **(properties.get("headers") or {}),
+            "x-message-version": message_version,
+        }
+
+        return body, spec.BasicProperties(**properties)
+
+    def _send_attempt(
+            self,
+            result: Future,
+            routing_key: str,
+            body: Union[str, bytes],
+            properties: spec.BasicProperties,
+            attempt: int,
+            retries: int,
     ):
-        connection = self.get_connection()
-        try:
-            channel = connection.channel()
-
-            channel.exchange_declare(
-                exchange=self.exchange_name,
-                exchange_type=exchange_type,
-                passive=self.exchange_params.passive,
-                durable=self.exchange_params.durable,
-                auto_delete=self.exchange_params.auto_delete,
-                internal=self.exchange_params.internal,
-            )
-
-            if self.msg_parser:
-                body = self.msg_parser(body)
-
-            for key, value in self.default_send_properties.items():
-                if key not in properties:
-                    properties[key] = value
-
-            if "message_id" not in properties:
-                properties["message_id"] = sha256(
-                    json.dumps(body).encode("utf-8")
-                ).hexdigest()
-            if "timestamp" not in properties:
-                properties["timestamp"] = int(datetime.now().timestamp())
+        """Publishes a built message, retrying with a backoff until `result` can be resolved.
+        No retry is made once stopping, it would reconnect the publisher being closed."""
+        if attempt and self._stopping:
+            result.set_exception(AMQPConnectionError("Stopped before the message was sent"))
+            return
 
-            if properties.get("headers") is None:
-                properties["headers"] = {}
-            elif properties["headers"] is self.default_send_properties.get("headers"):
-                properties["headers"] = properties["headers"].copy()
+        confirm = self._publisher.publish(self.exchange_name, routing_key, body, properties)
 
-            properties["headers"]["x-message-version"] = message_version
+        def on_confirm(confirm: Future):
+            error = confirm.exception()
+            if error is None:
+                result.set_result(None)
+                return
 
-            channel.basic_publish(
-                exchange=self.exchange_name,
-                routing_key=routing_key,
-                body=body,
-                properties=spec.BasicProperties(**properties),
-            )
-
-        except Exception as err:
             LOGGER.error("Error while sending message")
-            LOGGER.error(err)
-
-            raise AMQPConnectionError from err
-
-        finally:
-            connection.close()
+            LOGGER.error(error)
+            if attempt + 1 >= retries or self._stopping:
+                result.set_exception(AMQPConnectionError(error))
+                return
+
+            delay = backoff_delay(attempt)
+            self._ioloop.add_callback_threadsafe(lambda: self._ioloop.call_later(
+                delay,
+                lambda: self._send_attempt(
+                    result, routing_key, body, properties, attempt + 1, retries
+                ),
+            ))
+
+        confirm.add_done_callback(on_confirm)
+
+    def _track_send(self, result: Future) -> Future:
+        """Has `stop` wait for `result` before closing the connections"""
+        with self._sends_lock:
+            self._unconfirmed_sends.add(result)
+        result.add_done_callback(self._discard_send)
+        return result
+
+    def _discard_send(self, result: Future):
+        with self._sends_lock:
+            self._unconfirmed_sends.discard(result)
 
     def send(
             self,
             body,
             routing_key: str,
-            exchange_type: ExchangeType = ExchangeType.DEFAULT,
+            exchange_type: Union[ExchangeType, None] = None,
             retries: int = 5,
             message_version: str = "v1.0.0",
             **properties,
-    ):
-        """Sends a message to a given routing key
+    ) -> Future:
+        """Sends a message to a given routing key, without waiting for it to be confirmed
 
         Args:
             body (str): The body to be sent
             routing_key (str): The routing key for the message
-            exchange_type (ExchangeType, optional): The exchange type to be used. Defaults to ExchangeType.DEFAULT.
+            exchange_type (ExchangeType, optional): Deprecated and ignored, the exchange has a single type. Defaults to None.
             retries (int, optional): Number of retries to send the message. Defaults to 5.
             message_version (str): Message version number.
             properties (dict[str, Any]): Additional properties to pass to spec.BasicProperties
+
+        Returns:
+            Future: Resolved once the broker confirmed the message, or failed with the last error once out of retries
         """
 
-        thread = Thread(
-            target=lambda: self.sync_send(
-                body, routing_key, exchange_type, retries, message_version, **properties
-            ),
-        )
-        thread.daemon = True
-        thread.start()
+        if exchange_type is not None:
+            _warn_exchange_type()
+
+        result = Future()
+        if self._stopping:
+            result.set_exception(RuntimeError("Can't send messages after `stop`"))
+            return result
+
+        try:
+            body, props = self._build_message(body, message_version, **properties)
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.error("Error while sending message")
+            LOGGER.error(err)
+            result.set_exception(err)
+            return result
+
+        self._track_send(result)
+
+        self._start_ioloop()
+        self._send_attempt(result, routing_key, body, props, 0, retries)
+        return result
 
     def sync_send(
             self,
             body,
             routing_key: str,
-            exchange_type: ExchangeType = ExchangeType.DEFAULT,
+            exchange_type: Union[ExchangeType, None] = None,
             retries: int = 5,
             message_version: str = "v1.0.0",
+            timeout: Union[float, None] = 120,
             **properties,
     ):
-        """Sends a message to a given routing key synchronously
+        """Sends a message to a given routing key synchronously, waiting for the broker to confirm it
 
         Args:
             body (str): The body to be sent
             routing_key (str): The routing key for the message
-            exchange_type (ExchangeType, optional): The exchange type to be used. Defaults to ExchangeType.DEFAULT.
+            exchange_type (ExchangeType, optional): Deprecated and ignored, the exchange has a single type. Defaults to None.
             retries (int, optional): Number of retries to send the message. Defaults to 5.
             message_version (str): Message version number.
+            timeout (float, optional): Max seconds to wait for the message to be sent, retries included,
+                before raising `concurrent.futures.TimeoutError`. None waits forever. Defaults to 120.
             properties (dict[str, Any]): Additional properties to pass to spec.BasicProperties
         """
 
-        retry_call(
-            self._send_msg,
-            (body, routing_key, exchange_type, message_version),
-            properties,
-            exceptions=(AMQPConnectionError, AssertionError),
-            tries=retries,
-            delay=5,
-            jitter=(5, 15),
-        )
+        if exchange_type is not None:
+            _warn_exchange_type()
+
+        self.send(body, routing_key, None, retries, message_version, **properties).result(timeout)
@@ -0,0 +1,151 @@
+import logging
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, Tuple, Union
+
+from pika import SelectConnection, spec
+from pika.adapters.select_connection import IOLoop
+from pika.channel import Channel
+from pika.connection import Parameters
+from pika.exceptions import AMQPConnectionError, AMQPError
+
+LOGGER = logging.getLogger(__name__)
+
+# (exchange, routing_key, body, properties, future)
+Publish = Tuple[str, str, Union[str, bytes], spec.BasicProperties, Future]
+
+# Called with the new publisher channel and the callback to call once it's ready to publish
+OnPublisherChannelOpen = Callable[[Channel, Callable[[], None]], None]
+
+
+class RabbitPublisher:
+    """Publishes messages with publisher confirms over its own `SelectConnection`, run by
+    `ioloop`. The connection is opened on the first publish, and again on the next one
+    after it's lost.
+
+    `publish` can be called from any thread, everything else runs on the IO thread. Many
+    messages can be waiting for their confirm at once, the broker acks them in batches."""
+
+    def __init__(
+            self,
+            parameters: Parameters,
+            ioloop: IOLoop,
+            on_channel_open: OnPublisherChannelOpen,
+    ) -> None:
+        self.parameters = parameters
+        self.ioloop = ioloop
+        self.on_channel_open = on_channel_open
+
+        self._connection: Union[SelectConnection, None] = None
+        # Only set once the channel is ready to publish
+        self._channel: Union[Channel, None] = None
+        self._delivery_tag = 0
+        self._unconfirmed: Dict[int, Future] = {}
+        self._queued: Deque[Publish] = deque()
+
+    @property
+    def is_closed(self) -> bool:
+        return self._connection is None or self._connection.is_closed
+
+    def publish(
+            self,
+            exchange: str,
+            routing_key: str,
+            body: Union[str, bytes],
+            properties: spec.BasicProperties,
+    ) -> Future:
+        """Publishes a message, the returned future resolves once the broker confirmed it"""
+        future = Future()
+        self.ioloop.add_callback_threadsafe(
+            lambda: self._publish((exchange, routing_key, body, properties, future))
+        )
+        return future
+
+    def close(self):
+        """Closes the connection, runs on the IO thread"""
+        connection = self._connection
+        if connection is not None and not (connection.is_closing or connection.is_closed):
+            connection.close()
+
+    def _publish(self, publish: Publish):
+        if self._channel is None:
+            self._queued.append(publish)
+            if self._connection is None:
+                self._connect()
+            return
+
+        exchange, routing_key, body, properties, future = publish
+        try:
+            self._channel.basic_publish(exchange, routing_key, body, properties)
+        except Exception as err:  # pylint: disable=broad-except
+            future.set_exception(err)
+            return
+
+        self._delivery_tag += 1
+        self._unconfirmed[self._delivery_tag] = future
+
+    def _connect(self):
+        self._connection = SelectConnection(
+            self.parameters,
+            on_open_callback=lambda connection: connection.channel(
+                on_open_callback=self._on_channel_open
+            ),
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.ioloop,
+        )
+
+    def _on_channel_open(self, channel: Channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        self._delivery_tag = 0
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=lambda _: self.on_channel_open(channel, lambda: self._on_ready(channel)),
+        )
+
+    def _on_ready(self, channel: Channel):
+        if not channel.is_open:
+            return
+
+        self._channel = channel
+        while self._queued and self._channel is not None:
+            self._publish(self._queued.popleft())
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        tags = [method.delivery_tag]
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+
+        for tag in tags:
+            future = self._unconfirmed.pop(tag, None)
+            if future is None:
+                continue
+            if isinstance(method, spec.Basic.Ack):
+                future.set_result(None)
+            else:
+                future.set_exception(AMQPError("Message nacked by the broker"))
+
+    def _on_channel_closed(self, _: Channel, reason: Exception):
+        self._channel = None
+        self._fail(reason)
+
+        # The connection is only used by this channel, the next publish reconnects
+        self.close()
+
+    def _on_connection_closed(self, _: SelectConnection, reason: Exception):
+        self._connection = None
+        self._channel = None
+        self._fail(reason)
+
+    def _fail(self, reason: Exception):
+        """Fails every message waiting for the channel or for its confirm"""
+        futures = list(self._unconfirmed.values())
+        futures.extend(publish[-1] for publish in self._queued)
+        self._unconfirmed.clear()
+        self._queued.clear()
+
+        if futures:
+            LOGGER.warning(f"Publisher connection lost ({reason!r}), failing {len(futures)} message(s)")
+        for future in futures:
+            future.set_exception(AMQPConnectionError(reason))
@@ -1,3 +1,4 @@
+from .JsonParser import json_body_parser, json_msg_parser
 from .RabbitConsumerMiddleware import (
     RabbitConsumerMessage,
     RabbitConsumerMiddleware,
@@ -12,6 +13,8 @@ __version__ = '.'.join(map(str, __version_info__))
 __all__ = [
     "__version__",
     "ExchangeType",
+    "json_body_parser",
+    "json_msg_parser",
     "RabbitMQ",
     "RabbitConsumerMessage",
     "RabbitConsumerMiddleware",